@@ -4,12 +4,33 @@ Convert MLX fused model to GGUF format for Ollama
 """
 
 import argparse
+import hashlib
+import importlib.util
 import subprocess
 import sys
 import os
 from pathlib import Path
 import shutil
 
+# Local llama.cpp checkout providing the convert script and llama-quantize
+LLAMA_CPP_PATH = "/Volumes/AI_SSD/ai-local/llama.cpp"
+
+# Pinned llama.cpp commit to download the convert script from, and the script's
+# sha256 at that commit. Later revisions split the script into a `conversion`
+# package, so it can no longer be fetched as a single file. Override both
+# LLAMA_CPP_REF and CONVERT_SCRIPT_SHA256 together to move the pin.
+LLAMA_CPP_REF = os.environ.get('LLAMA_CPP_REF', '4227c9be4268ac844921b90f31595f81236bd317')
+CONVERT_SCRIPT_SHA256 = os.environ.get(
+    'CONVERT_SCRIPT_SHA256', 'a508782450d00f07135d178290bf65d8612440ebf05ae4b9cbb951dc468a94ab'
+)
+CONVERT_SCRIPT_URL = "https://raw.githubusercontent.com/ggml-org/llama.cpp/{ref}/convert_hf_to_gguf.py"
+
+# Cache for downloaded llama.cpp files
+CACHE_DIR = Path.home() / '.cache' / 'luddo-ai'
+
+# GGUF quantization type - best size/quality balance for 4-bit
+GGUF_QUANT_TYPE = 'Q4_K_M'
+
 def check_llama_cpp():
     """Check if llama.cpp conversion tools are available"""
     try:
@@ -21,11 +42,32 @@ def check_llama_cpp():
     except:
         return False
 
+# pip package -> importable module for each conversion dependency
+CONVERSION_DEPS = {
+    'transformers': 'transformers',
+    'torch': 'torch',
+    'sentencepiece': 'sentencepiece',
+    'protobuf': 'google.protobuf',
+    # The downloaded convert script imports gguf-py, which ships with llama.cpp
+    'gguf>=0.17.1': 'gguf',
+}
+
+def is_importable(module: str) -> bool:
+    """Check if a module can be imported without importing it"""
+    try:
+        return importlib.util.find_spec(module) is not None
+    except ModuleNotFoundError:
+        return False
+
 def install_conversion_deps():
-    """Install required dependencies for conversion"""
-    print("Installing conversion dependencies...")
-    subprocess.run([sys.executable, '-m', 'pip', 'install',
-                   'transformers', 'torch', 'sentencepiece', 'protobuf', '-q'], check=True)
+    """Install required dependencies for conversion that are not already present"""
+    missing = [pkg for pkg, module in CONVERSION_DEPS.items() if not is_importable(module)]
+    if not missing:
+        return
+
+    print(f"Installing conversion dependencies: {', '.join(missing)}...")
+    subprocess.run([sys.executable, '-m', 'pip', 'install', *missing, '-q'],
+                   stdout=subprocess.DEVNULL, check=True)
 
 def convert_mlx_to_hf(mlx_path: str, hf_path: str):
     """Convert MLX model to HuggingFace format"""
@@ -39,41 +81,111 @@ def convert_mlx_to_hf(mlx_path: str, hf_path: str):
     if dst.exists():
         shutil.rmtree(dst)
 
-    # Copy all files
-    shutil.copytree(src, dst)
+    # Clone all files - macOS `cp -c` uses clonefile(2), which is O(1) on APFS
+    result = subprocess.run(['cp', '-c', '-R', str(src), str(dst)], capture_output=True)
+    if result.returncode != 0:
+        if dst.exists():
+            shutil.rmtree(dst)
+        shutil.copytree(src, dst)
 
     # The config.json and tokenizer files should be compatible
     return True
 
+def file_sha256(path: Path) -> str:
+    """Compute the sha256 hex digest of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def find_convert_script() -> Path:
+    """Locate convert_hf_to_gguf.py, downloading and caching it on first use.
+
+    A local llama.cpp checkout is preferred. Downloads come from the pinned
+    LLAMA_CPP_REF and are checked against CONVERT_SCRIPT_SHA256, both on download
+    and on every later use of the cached copy.
+    """
+    local_script = Path(LLAMA_CPP_PATH) / 'convert_hf_to_gguf.py'
+    if local_script.exists():
+        return local_script
+
+    cache_dir = CACHE_DIR / 'llama.cpp' / LLAMA_CPP_REF
+    convert_script = cache_dir / 'convert_hf_to_gguf.py'
+
+    if convert_script.exists():
+        if file_sha256(convert_script) == CONVERT_SCRIPT_SHA256:
+            return convert_script
+        print("Cached conversion script failed hash check, downloading again...")
+
+    # Download the convert script from llama.cpp
+    print(f"Downloading llama.cpp conversion script ({LLAMA_CPP_REF})...")
+    import urllib.request
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_script = convert_script.with_suffix('.tmp')
+    urllib.request.urlretrieve(CONVERT_SCRIPT_URL.format(ref=LLAMA_CPP_REF), tmp_script)
+
+    actual = file_sha256(tmp_script)
+    if actual != CONVERT_SCRIPT_SHA256:
+        tmp_script.unlink()
+        raise Exception(f"Conversion script hash mismatch: expected {CONVERT_SCRIPT_SHA256}, got {actual}")
+
+    os.replace(tmp_script, convert_script)
+    return convert_script
+
+def find_llama_quantize() -> str:
+    """Locate llama-quantize, preferring an installed binary on PATH"""
+    quantize_bin = shutil.which('llama-quantize')
+    if quantize_bin:
+        return quantize_bin
+    quantize_bin = os.path.join(LLAMA_CPP_PATH, 'build', 'bin', 'llama-quantize')
+    return quantize_bin if os.path.exists(quantize_bin) else None
+
+def quantize_gguf(f16_path: str, output_path: str):
+    """Quantize an F16 GGUF file to GGUF_QUANT_TYPE with llama-quantize"""
+    quantize_bin = find_llama_quantize()
+    if not quantize_bin:
+        raise Exception("llama-quantize not found on PATH or in the llama.cpp checkout")
+
+    print(f"Quantizing to {GGUF_QUANT_TYPE}...")
+    result = subprocess.run(
+        [quantize_bin, f16_path, output_path, GGUF_QUANT_TYPE],
+        capture_output=True, text=True
+    )
+
+    if result.returncode != 0:
+        print(f"GGUF quantization output: {result.stdout}")
+        print(f"GGUF quantization errors: {result.stderr}")
+        raise Exception(f"GGUF quantization failed: {result.stderr}")
+
 def convert_hf_to_gguf(hf_path: str, gguf_path: str, model_name: str):
     """Convert HuggingFace model to GGUF using llama.cpp"""
     print(f"Converting to GGUF format...")
 
-    # Try using the llama.cpp convert script
-    # First, try to find or download the convert script
-    convert_script = Path(__file__).parent / 'convert_hf_to_gguf.py'
+    convert_script = find_convert_script()
 
-    if not convert_script.exists():
-        # Download the convert script from llama.cpp
-        print("Downloading llama.cpp conversion script...")
-        import urllib.request
-        url = "https://raw.githubusercontent.com/ggerganov/llama.cpp/master/convert_hf_to_gguf.py"
-        urllib.request.urlretrieve(url, convert_script)
-
-    # Run conversion
+    # Run conversion to an F16 intermediate, then quantize with llama-quantize
+    f16_path = str(Path(gguf_path).with_suffix('.f16.gguf'))
     cmd = [
         sys.executable, str(convert_script),
         hf_path,
-        '--outfile', gguf_path,
-        '--outtype', 'q4_0'  # 4-bit quantization
+        '--outfile', f16_path,
+        '--outtype', 'f16'
     ]
 
-    result = subprocess.run(cmd, capture_output=True, text=True)
-
-    if result.returncode != 0:
-        print(f"GGUF conversion output: {result.stdout}")
-        print(f"GGUF conversion errors: {result.stderr}")
-        raise Exception(f"GGUF conversion failed: {result.stderr}")
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True)
+
+        if result.returncode != 0:
+            print(f"GGUF conversion output: {result.stdout}")
+            print(f"GGUF conversion errors: {result.stderr}")
+            raise Exception(f"GGUF conversion failed: {result.stderr}")
+
+        quantize_gguf(f16_path, gguf_path)
+    finally:
+        # Never leave the multi-GB F16 intermediate behind
+        if os.path.exists(f16_path):
+            os.remove(f16_path)
 
     return True
 
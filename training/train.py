@@ -7,18 +7,75 @@ Trains on JSONL datasets generated from simulations.
 """
 
 import argparse
+import collections
 import json
 import os
+import re
+import selectors
 import sys
+import threading
 from pathlib import Path
 from datetime import datetime
 import subprocess
 import shutil
+import struct
+import time
+from types import MappingProxyType
 
-def write_progress(progress_file: str, data: dict):
-    """Write progress to file for Node.js to read"""
-    with open(progress_file, 'w') as f:
-        json.dump(data, f)
+from convert_to_gguf import GGUF_QUANT_TYPE, find_convert_script, install_conversion_deps, quantize_gguf
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def json_loads(data):
+    """Parse JSON, using orjson when available"""
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def json_dumps_bytes(obj) -> bytes:
+    """Serialize JSON to bytes, using orjson when available"""
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode('utf-8')
+
+# Matches MLX-LM report lines like "Iter 350: Train loss 0.158, Learning Rate 1.000e-05, ..."
+TRAIN_REPORT_PATTERN = re.compile(
+    r'Iter\s+(\d+):\s*Train loss\s+([0-9.eE+-]+)(?:,\s*Learning Rate\s+([0-9.eE+-]+))?'
+)
+
+# Loss entries kept in memory / exposed in each progress update
+LOSS_HISTORY_SIZE = 1000
+UI_LOSS_HISTORY_SIZE = 50
+CHECKPOINT_LOSS_HISTORY_SIZE = 100
+
+# Lines of training subprocess output kept for failure reports
+RECENT_OUTPUT_LINES = 50
+
+# Minimum seconds between progress writes within the same stage (<= 5 Hz)
+PROGRESS_WRITE_INTERVAL = 0.2
+
+_last_write_ts = 0.0
+_last_stage = None
+
+def write_progress(progress_file: str, data: dict, force: bool = False):
+    """Write progress to file for Node.js to read.
+
+    Writes within the same stage are debounced; the file is replaced atomically
+    so the reader never sees a partial write.
+    """
+    global _last_write_ts, _last_stage
+
+    now = time.monotonic()
+    stage = data.get('stage')
+    if not force and stage == _last_stage and now - _last_write_ts < PROGRESS_WRITE_INTERVAL:
+        return
+
+    tmp_file = progress_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(json_dumps_bytes(data))
+    os.replace(tmp_file, progress_file)
+
+    _last_write_ts = now
+    _last_stage = stage
 
 def check_mlx_installed():
     """Check if MLX-LM is installed"""
@@ -30,45 +87,240 @@ def check_mlx_installed():
 
 def install_mlx():
     """Install MLX-LM"""
-    subprocess.run([sys.executable, '-m', 'pip', 'install', 'mlx-lm', '-q'], check=True)
-
-def convert_jsonl_to_mlx_format(input_path: str, output_dir: str) -> int:
-    """Convert JSONL dataset to MLX format"""
-    examples = []
-    with open(input_path, 'r') as f:
-        for line in f:
-            if line.strip():
-                data = json.loads(line)
-                messages = data.get('messages', [])
-                # Format as text for MLX
-                text = ""
-                for msg in messages:
-                    role = msg.get('role', 'user')
-                    content = msg.get('content', '')
-                    if role == 'system':
-                        text += f"<|system|>\n{content}\n"
-                    elif role == 'user':
-                        text += f"<|user|>\n{content}\n"
-                    elif role == 'assistant':
-                        text += f"<|assistant|>\n{content}\n"
-                examples.append({"text": text})
+    subprocess.run([sys.executable, '-m', 'pip', 'install', 'mlx-lm', '-q'],
+                   stdout=subprocess.DEVNULL, check=True)
+
+# Token length examples are truncated to and packed into
+MAX_SEQ_LENGTH = 512
+
+# Buffer size for dataset reads and writes
+IO_BUFFER_SIZE = 1 << 20
+
+ROLE_TAGS = {
+    'system': '<|system|>',
+    'user': '<|user|>',
+    'assistant': '<|assistant|>',
+}
+
+def format_messages(messages: list) -> str:
+    """Format chat messages as tagged text for MLX"""
+    return "".join(
+        f"{ROLE_TAGS[msg.get('role', 'user')]}\n{msg.get('content', '')}\n"
+        for msg in messages
+        if msg.get('role', 'user') in ROLE_TAGS
+    )
+
+# Per-worker tokenizer for sharded tokenization
+TOK = None
+
+# Datasets smaller than this are tokenized in a single batched call
+POOL_MIN_EXAMPLES = 20000
+
+def _init_tok(hf_model: str):
+    """Load one tokenizer per pool worker"""
+    global TOK
+    from transformers import AutoTokenizer
+    TOK = AutoTokenizer.from_pretrained(hf_model)
+
+def _tokenize_chunk(chunk: list) -> list:
+    """Tokenize a shard of formatted example texts, returning per-example token counts"""
+    input_ids = TOK(chunk, add_special_tokens=False)['input_ids']
+    return [len(ids) for ids in input_ids]
+
+def tokenize_sharded(texts: list, hf_model: str) -> list:
+    """Tokenize example texts, sharding large datasets across a worker pool"""
+    num_workers = min(8, max(1, (os.cpu_count() or 1) // 4))
+
+    if len(texts) < POOL_MIN_EXAMPLES or num_workers == 1:
+        _init_tok(hf_model)
+        return _tokenize_chunk(texts)
+
+    import multiprocessing
+    chunk_size = (len(texts) + num_workers * 4 - 1) // (num_workers * 4)
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+
+    # spawn rather than fork: forking after the Rust tokenizer threads start is unsafe on macOS
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(num_workers, initializer=_init_tok, initargs=(hf_model,)) as pool:
+        results = pool.map(_tokenize_chunk, chunks)
+
+    return [length for chunk_lengths in results for length in chunk_lengths]
+
+# Bump when the way examples are tokenized changes, to invalidate old caches
+TOKEN_CACHE_SCHEME = 'tagged_text_untruncated'
+
+def tokenize_examples(texts: list, hf_model: str, cache_dir: str, source_path: str) -> list:
+    """Tokenize the example texts written to train.jsonl and return their lengths.
+
+    Only the per-example token counts are cached. The cache is keyed on the model,
+    tokenization scheme and max length, and is only reused while it is newer than
+    the source dataset. A cache hit skips this pass entirely, leaving packing to
+    re-tokenize only the packs near the length limit. MLX-LM still tokenizes the
+    text records it trains on itself.
+    """
+    import numpy as np
+
+    lengths_file = os.path.join(cache_dir, 'lengths.npy')
+    meta_file = os.path.join(cache_dir, 'token_cache.json')
+    meta = {
+        'hf_model': hf_model,
+        'scheme': TOKEN_CACHE_SCHEME,
+        'max_seq_length': MAX_SEQ_LENGTH,
+        'num_examples': len(texts),
+    }
+
+    # Reuse cache if it was built the same way and is newer than the source dataset
+    if (os.path.exists(lengths_file) and os.path.exists(meta_file)
+            and os.path.getmtime(lengths_file) >= os.path.getmtime(source_path)):
+        with open(meta_file, 'rb') as f:
+            cached_meta = json_loads(f.read())
+        lengths = np.load(lengths_file)
+        if cached_meta == meta and len(lengths) == len(texts):
+            return lengths.tolist()
+
+    lengths = tokenize_sharded(texts, hf_model)
+
+    np.save(lengths_file, np.asarray(lengths, dtype=np.int32))
+    with open(meta_file, 'wb') as f:
+        f.write(json_dumps_bytes(meta))
+
+    return lengths
+
+def pack_examples(texts: list, lengths: list, separator_length: int, overhead: int,
+                  max_length: int = MAX_SEQ_LENGTH) -> list:
+    """Greedily group whole examples into packs of at most max_length tokens.
+
+    overhead is the special tokens MLX-LM adds to every sequence (BOS and the
+    trailing EOS); separator_length is the EOS joining two examples. Returns
+    (texts, estimated length) pairs.
+    """
+    packs = []
+    current = []
+    current_length = overhead
+    for text, length in zip(texts, lengths):
+        added = length + (separator_length if current else 0)
+        if current and current_length + added > max_length:
+            packs.append((current, current_length))
+            current = []
+            current_length = overhead
+            added = length
+        current.append(text)
+        current_length += added
+    if current:
+        packs.append((current, current_length))
+    return packs
+
+def sequence_lengths(texts: list) -> list:
+    """Token counts of texts as MLX-LM's text loader builds them (BOS + text + EOS)"""
+    input_ids = TOK(texts)['input_ids']
+    return [len(ids) + (0 if ids and ids[-1] == TOK.eos_token_id else 1) for ids in input_ids]
+
+# Tokens a single join may add beyond the summed example lengths
+PACK_JOIN_SLACK = 2
+
+def fit_packs(packs: list, separator: str, max_length: int = MAX_SEQ_LENGTH) -> list:
+    """Join packs into sequences, verifying none exceeds max_length tokens.
+
+    Token counts are nearly additive across a join, so only multi-example packs
+    whose estimate comes within PACK_JOIN_SLACK per join of max_length are
+    re-tokenized; any that overflow are emitted as their separate examples
+    rather than letting MLX-LM truncate the tail of their last example.
+    """
+    sequences = [separator.join(pack) for pack, _ in packs]
+    near_limit = [
+        i for i, (pack, estimate) in enumerate(packs)
+        if len(pack) > 1 and estimate + PACK_JOIN_SLACK * (len(pack) - 1) > max_length
+    ]
+    if not near_limit:
+        return sequences
+
+    lengths = sequence_lengths([sequences[i] for i in near_limit])
+    overflowing = {i for i, length in zip(near_limit, lengths) if length > max_length}
+    fitted = []
+    for i, ((pack, _), text) in enumerate(zip(packs, sequences)):
+        if i in overflowing:
+            fitted.extend(pack)
+        else:
+            fitted.append(text)
+    return fitted
 
-    # Split into train/valid
-    split_idx = max(1, int(len(examples) * 0.9))
-    train_data = examples[:split_idx]
-    valid_data = examples[split_idx:] if split_idx < len(examples) else examples[-1:]
+def get_eos_token(hf_model: str) -> str:
+    """Get the EOS token string for the model's tokenizer"""
+    if TOK is None:
+        _init_tok(hf_model)
+    if not TOK.eos_token:
+        raise ValueError(f"Tokenizer for {hf_model} has no EOS token to separate packed examples")
+    return TOK.eos_token
 
-    # Write files
-    os.makedirs(output_dir, exist_ok=True)
-    with open(os.path.join(output_dir, 'train.jsonl'), 'w') as f:
-        for ex in train_data:
-            f.write(json.dumps(ex) + '\n')
+def convert_jsonl_to_mlx_format(input_path: str, output_dir: str, hf_model: str = None) -> tuple:
+    """Convert JSONL dataset to MLX format, pre-tokenizing and packing if a model is given.
 
-    with open(os.path.join(output_dir, 'valid.jsonl'), 'w') as f:
-        for ex in valid_data:
-            f.write(json.dumps(ex) + '\n')
+    Returns (number of examples, number of training sequences).
+    """
+    with open(input_path, 'rb', buffering=IO_BUFFER_SIZE) as f:
+        all_messages = [json_loads(line).get('messages', []) for line in f if line.strip()]
 
-    return len(examples)
+    # Text fallback for the MLX loader, which does not accept token IDs
+    texts = [format_messages(messages) for messages in all_messages]
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Split into train/valid
+    split_idx = max(1, int(len(texts) * 0.9))
+    train_texts = texts[:split_idx]
+    valid_texts = texts[split_idx:] if split_idx < len(texts) else texts[-1:]
+
+    # Count tokens (cached across runs), then pack examples into MAX_SEQ_LENGTH sequences
+    if hf_model:
+        lengths = tokenize_examples(texts, hf_model, output_dir, input_path)
+        eos = get_eos_token(hf_model)
+        separator_length = len(TOK(eos, add_special_tokens=False)['input_ids'])
+        overhead = sequence_lengths([''])[0]
+        train_lengths = lengths[:split_idx]
+        valid_lengths = lengths[split_idx:] if split_idx < len(lengths) else lengths[-1:]
+        train_texts = fit_packs(pack_examples(train_texts, train_lengths, separator_length, overhead), eos)
+        valid_texts = fit_packs(pack_examples(valid_texts, valid_lengths, separator_length, overhead), eos)
+
+    # Write files through a large buffer - few syscalls, no giant joined string
+    with open(os.path.join(output_dir, 'train.jsonl'), 'wb', buffering=IO_BUFFER_SIZE) as f:
+        f.writelines(json_dumps_bytes({"text": text}) + b'\n' for text in train_texts)
+
+    with open(os.path.join(output_dir, 'valid.jsonl'), 'wb', buffering=IO_BUFFER_SIZE) as f:
+        f.writelines(json_dumps_bytes({"text": text}) + b'\n' for text in valid_texts)
+
+    return len(texts), len(train_texts)
+
+def read_output_bursts(process, chunk_size: int = 1 << 16):
+    """Yield lists of complete output lines from a subprocess as they arrive.
+
+    The pipe is read non-blocking and drained fully on every wakeup, so a burst of
+    report lines is handled together and the child never blocks on a full pipe.
+    """
+    fd = process.stdout.fileno()
+    os.set_blocking(fd, False)
+    buffer = bytearray()
+
+    with selectors.DefaultSelector() as selector:
+        selector.register(fd, selectors.EVENT_READ)
+        eof = False
+        while not eof:
+            selector.select()
+            while True:
+                try:
+                    chunk = os.read(fd, chunk_size)
+                except BlockingIOError:
+                    break
+                if not chunk:
+                    eof = True
+                    break
+                buffer += chunk
+
+            *lines, rest = buffer.split(b'\n')
+            if eof and rest:
+                lines.append(rest)
+            buffer = bytearray(rest)
+            if lines:
+                yield [line.decode('utf-8', errors='replace').rstrip('\r') for line in lines]
 
 def load_checkpoint(checkpoint_file: str) -> dict:
     """Load checkpoint state if exists"""
@@ -78,9 +330,108 @@ def load_checkpoint(checkpoint_file: str) -> dict:
     return None
 
 def save_checkpoint(checkpoint_file: str, data: dict):
-    """Save checkpoint state"""
-    with open(checkpoint_file, 'w') as f:
-        json.dump(data, f)
+    """Save checkpoint state durably - a crash mid-write never corrupts the resume file"""
+    tmp_file = checkpoint_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(json_dumps_bytes(data))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, checkpoint_file)
+
+# Bytes copied per read when merging safetensors shards
+MERGE_BLOCK_SIZE = 64 * 1024 * 1024
+
+def read_safetensors_header(path: Path) -> tuple:
+    """Read a safetensors header, returning (header dict, data start offset)"""
+    with open(path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    return header, 8 + header_size
+
+def merge_safetensors_shards(src_dir: str, dst_dir: str) -> str:
+    """Merge sharded safetensors into a single model.safetensors block by block.
+
+    Tensor bytes are copied straight from the shards, so at most one block is held
+    in memory and no model is instantiated; dtypes are left as written by the fuse.
+    """
+    src = Path(src_dir)
+    dst = Path(dst_dir)
+    dst.mkdir(parents=True, exist_ok=True)
+
+    # Build the merged header from each shard's header
+    merged_header = {'__metadata__': {'format': 'pt'}}
+    sources = []
+    offset = 0
+    for shard in sorted(src.glob('*.safetensors')):
+        header, data_start = read_safetensors_header(shard)
+        header.pop('__metadata__', None)
+        for name, info in sorted(header.items(), key=lambda item: item[1]['data_offsets'][0]):
+            begin, end = info['data_offsets']
+            merged_header[name] = {
+                'dtype': info['dtype'],
+                'shape': info['shape'],
+                'data_offsets': [offset, offset + end - begin],
+            }
+            sources.append((shard, data_start + begin, end - begin))
+            offset += end - begin
+
+    header_bytes = json.dumps(merged_header, separators=(',', ':')).encode('utf-8')
+    header_bytes += b' ' * (-len(header_bytes) % 8)
+
+    output_file = dst / 'model.safetensors'
+    with open(output_file, 'wb') as out:
+        out.write(struct.pack('<Q', len(header_bytes)))
+        out.write(header_bytes)
+        for shard, start, length in sources:
+            with open(shard, 'rb') as f:
+                f.seek(start)
+                while length > 0:
+                    block = f.read(min(MERGE_BLOCK_SIZE, length))
+                    out.write(block)
+                    length -= len(block)
+
+    # Carry over config and tokenizer files
+    for item in src.iterdir():
+        if item.is_file() and item.suffix != '.safetensors' and item.name != 'model.safetensors.index.json':
+            shutil.copy2(item, dst / item.name)
+
+    return str(output_file)
+
+# Map Ollama model names to HuggingFace MLX models
+MODEL_MAPPING = MappingProxyType({
+    'llama3.2:3b': 'mlx-community/Llama-3.2-3B-Instruct-4bit',
+    'llama3.2:1b': 'mlx-community/Llama-3.2-1B-Instruct-4bit',
+    'llama3.1:8b': 'mlx-community/Meta-Llama-3.1-8B-Instruct-4bit',
+    'mistral:7b': 'mlx-community/Mistral-7B-Instruct-v0.3-4bit',
+    'qwen2.5:3b': 'mlx-community/Qwen2.5-3B-Instruct-4bit',
+    'qwen2.5:7b': 'mlx-community/Qwen2.5-7B-Instruct-4bit',
+})
+
+# Custom models map to their base models
+# These are fine-tuned variants that should use the same HF model for continued training
+CUSTOM_MODEL_BASES = MappingProxyType({
+    'luddo-expert': 'llama3.2:3b',
+    'luddo-expert:latest': 'llama3.2:3b',
+    'llama3.2-luddo-finetuned': 'llama3.2:3b',
+})
+
+# Model name -> HF model, with custom models flattened onto their base
+RESOLVE: dict = dict(MODEL_MAPPING)
+for _custom_model, _base_model in CUSTOM_MODEL_BASES.items():
+    RESOLVE[_custom_model] = MODEL_MAPPING[_base_model]
+
+def _fuzzy_resolve(model_name: str) -> str:
+    """Resolve a model name with no exact mapping to a HuggingFace MLX model"""
+    name_lower = model_name.lower()
+    if 'luddo' in name_lower or 'expert' in name_lower or 'finetuned' in name_lower:
+        # Default to llama3.2:3b for any luddo custom models
+        hf_model = MODEL_MAPPING['llama3.2:3b']
+        print(f"Custom model detected, using base: {hf_model}")
+        return hf_model
+
+    # Try to use MLX community variant for unknown models
+    base_name = model_name.replace(':', '-').title()
+    return f'mlx-community/{base_name}-4bit'
 
 def main():
     parser = argparse.ArgumentParser(description='Fine-tune Luddo AI model')
@@ -92,6 +443,7 @@ def main():
     parser.add_argument('--output-dir', help='Directory for output model')
     parser.add_argument('--resume', action='store_true', help='Resume from checkpoint if available')
     parser.add_argument('--config', help='Path to JSON config file (overrides other args)')
+    parser.add_argument('--verbose', action='store_true', help='Echo MLX-LM training output to stdout')
     args = parser.parse_args()
 
     # Load config from file if provided (for PM2 process management)
@@ -105,6 +457,7 @@ def main():
         args.progress_file = config.get('progressFile', args.progress_file)
         args.output_dir = config.get('outputDir', args.output_dir)
         args.resume = config.get('resume', args.resume)
+        args.verbose = config.get('verbose', args.verbose)
 
     # Validate required arguments
     if not all([args.base_model, args.dataset, args.output, args.progress_file, args.output_dir]):
@@ -137,9 +490,6 @@ def main():
             })
             install_mlx()
 
-        import mlx_lm
-        from mlx_lm import lora, generate
-
         write_progress(progress_file, {
             'stage': 'loading_model',
             'progress': 5,
@@ -150,42 +500,19 @@ def main():
             'learning_rate': None
         })
 
-        # Map Ollama model names to HuggingFace MLX models
-        model_mapping = {
-            'llama3.2:3b': 'mlx-community/Llama-3.2-3B-Instruct-4bit',
-            'llama3.2:1b': 'mlx-community/Llama-3.2-1B-Instruct-4bit',
-            'llama3.1:8b': 'mlx-community/Meta-Llama-3.1-8B-Instruct-4bit',
-            'mistral:7b': 'mlx-community/Mistral-7B-Instruct-v0.3-4bit',
-            'qwen2.5:3b': 'mlx-community/Qwen2.5-3B-Instruct-4bit',
-            'qwen2.5:7b': 'mlx-community/Qwen2.5-7B-Instruct-4bit',
-        }
-
-        # Custom models map to their base models
-        # These are fine-tuned variants that should use the same HF model for continued training
-        custom_model_bases = {
-            'luddo-expert': 'llama3.2:3b',
-            'luddo-expert:latest': 'llama3.2:3b',
-            'llama3.2-luddo-finetuned': 'llama3.2:3b',
-        }
-
-        # Resolve custom models to their base
-        resolved_model = args.base_model
-        if args.base_model in custom_model_bases:
-            resolved_model = custom_model_bases[args.base_model]
-            print(f"Custom model '{args.base_model}' resolved to base model '{resolved_model}'")
-
-        hf_model = model_mapping.get(resolved_model)
-        if not hf_model:
-            # Check if it's a custom model variant (contains 'luddo' or 'expert')
-            base_lower = args.base_model.lower()
-            if 'luddo' in base_lower or 'expert' in base_lower or 'finetuned' in base_lower:
-                # Default to llama3.2:3b for any luddo custom models
-                hf_model = model_mapping['llama3.2:3b']
-                print(f"Custom model detected, using base: {hf_model}")
-            else:
-                # Try to use MLX community variant for unknown models
-                base_name = resolved_model.replace(':', '-').title()
-                hf_model = f'mlx-community/{base_name}-4bit'
+        hf_model = RESOLVE.get(args.base_model) or RESOLVE.get(args.base_model.lower()) or _fuzzy_resolve(args.base_model)
+        if args.base_model in CUSTOM_MODEL_BASES:
+            print(f"Custom model '{args.base_model}' resolved to base model '{CUSTOM_MODEL_BASES[args.base_model]}'")
+
+        # Validate the repo once up front rather than failing after data prep
+        try:
+            from huggingface_hub import repo_exists
+            model_found = repo_exists(hf_model)
+        except Exception as e:
+            print(f"Could not verify HuggingFace model {hf_model}: {e}")
+            model_found = True
+        if not model_found:
+            raise Exception(f"HuggingFace model not found: {hf_model}")
 
         write_progress(progress_file, {
             'stage': 'preparing_data',
@@ -207,12 +534,17 @@ def main():
 
         # Check for resume
         resume_from_iter = 0
-        loss_history = []
+        # Bounded history; ui_tail mirrors the last entries exposed in progress updates
+        loss_history = collections.deque(maxlen=LOSS_HISTORY_SIZE)
+        ui_tail = collections.deque(maxlen=UI_LOSS_HISTORY_SIZE)
+        checkpoint_tail = collections.deque(maxlen=CHECKPOINT_LOSS_HISTORY_SIZE)
         if args.resume:
             checkpoint = load_checkpoint(checkpoint_file)
             if checkpoint:
                 resume_from_iter = checkpoint.get('last_iter', 0)
-                loss_history = checkpoint.get('loss_history', [])
+                loss_history.extend(checkpoint.get('loss_history', []))
+                ui_tail.extend(loss_history)
+                checkpoint_tail.extend(loss_history)
                 print(f"Resuming from iteration {resume_from_iter}")
                 write_progress(progress_file, {
                     'stage': 'resuming',
@@ -222,12 +554,28 @@ def main():
                     'total_epochs': args.epochs,
                     'loss': checkpoint.get('last_loss'),
                     'learning_rate': 1e-5,
-                    'loss_history': loss_history[-50:]
+                    'loss_history': list(ui_tail)
                 })
 
-        # Convert dataset to MLX format
+        # Convert dataset to MLX format while the base model downloads
         data_dir = str(output_path / 'data')
-        dataset_size = convert_jsonl_to_mlx_format(args.dataset, data_dir)
+        from huggingface_hub import snapshot_download
+
+        # Daemon thread: a data error must end the process without waiting on the download
+        download_errors = []
+
+        def prefetch_model():
+            try:
+                snapshot_download(hf_model)
+            except Exception as e:
+                download_errors.append(e)
+
+        download_thread = threading.Thread(target=prefetch_model, daemon=True)
+        download_thread.start()
+        dataset_size, num_sequences = convert_jsonl_to_mlx_format(args.dataset, data_dir, hf_model)
+        download_thread.join()
+        if download_errors:
+            raise download_errors[0]
 
         write_progress(progress_file, {
             'stage': 'starting_training',
@@ -241,116 +589,18 @@ def main():
         })
 
         # Calculate iterations based on epochs
-        # Assuming batch size of 4, we get iterations per epoch
-        iters_per_epoch = max(1, dataset_size // 4)
+        # Assuming batch size of 4, we get iterations per epoch over the packed sequences
+        iters_per_epoch = max(1, num_sequences // 4)
         total_iters = iters_per_epoch * args.epochs
 
         # Train using MLX-LM LoRA
         # We'll use subprocess to call mlx_lm.lora which gives us progress output
         # adapter_path already defined above for checkpoint support
 
-        # Create training config
-        train_config = {
-            'model': hf_model,
-            'data': data_dir,
-            'train': True,
-            'iters': total_iters,
-            'batch_size': 4,
-            'num_layers': 16,  # Updated from lora_layers for new mlx_lm API
-            'learning_rate': 1e-5,
-            'adapter_path': adapter_path,
-        }
-
         # Run training with progress monitoring
-        loss_history = []
         current_epoch = 0
 
-        # Use mlx_lm.lora directly
-        try:
-            from mlx_lm.tuner.trainer import TrainingArgs, train
-            from mlx_lm.tuner.lora import LoRALinear
-            import mlx.core as mx
-
-            # Load model and tokenizer
-            write_progress(progress_file, {
-                'stage': 'loading_model',
-                'progress': 20,
-                'message': f'Loading {hf_model}...',
-                'epoch': 0,
-                'total_epochs': args.epochs,
-                'loss': None,
-                'learning_rate': None,
-                'dataset_size': dataset_size
-            })
-
-            model, tokenizer = mlx_lm.load(hf_model)
-
-            # Apply LoRA
-            write_progress(progress_file, {
-                'stage': 'applying_lora',
-                'progress': 25,
-                'message': 'Applying LoRA adapters...',
-                'epoch': 0,
-                'total_epochs': args.epochs,
-                'loss': None,
-                'learning_rate': None,
-                'dataset_size': dataset_size
-            })
-
-            # Training arguments
-            training_args = TrainingArgs(
-                batch_size=4,
-                iters=total_iters,
-                val_batches=5,
-                steps_per_report=10,
-                steps_per_eval=50,
-                save_every=100,
-                adapter_path=adapter_path,
-                max_seq_length=512,  # Reduced from 1024 - training examples are ~200 tokens
-                learning_rate=1e-5,
-            )
-
-            # Custom callback for progress
-            class ProgressCallback:
-                def __init__(self, progress_file, total_iters, epochs, dataset_size):
-                    self.progress_file = progress_file
-                    self.total_iters = total_iters
-                    self.epochs = epochs
-                    self.dataset_size = dataset_size
-                    self.loss_history = []
-                    self.iters_per_epoch = total_iters // epochs
-
-                def __call__(self, iteration, train_loss, val_loss, learning_rate):
-                    current_epoch = min(self.epochs, iteration // self.iters_per_epoch + 1)
-                    progress = 25 + int((iteration / self.total_iters) * 70)
-
-                    self.loss_history.append({
-                        'step': iteration,
-                        'loss': float(train_loss),
-                        'epoch': current_epoch
-                    })
-
-                    write_progress(self.progress_file, {
-                        'stage': 'training',
-                        'progress': min(progress, 95),
-                        'message': f'Training epoch {current_epoch}/{self.epochs}',
-                        'epoch': current_epoch,
-                        'total_epochs': self.epochs,
-                        'loss': float(train_loss),
-                        'learning_rate': float(learning_rate) if learning_rate else None,
-                        'dataset_size': self.dataset_size,
-                        'step': iteration,
-                        'total_steps': self.total_iters,
-                        'loss_history': self.loss_history[-50:]
-                    })
-
-            # Note: MLX-LM train doesn't have callback support directly
-            # We'll use the CLI approach with output parsing instead
-
-        except Exception as e:
-            print(f"Direct training failed: {e}, using CLI approach")
-
-        # Fallback: Use CLI approach with subprocess
+        # Use CLI approach with subprocess - the model is only loaded in the child
         write_progress(progress_file, {
             'stage': 'training',
             'progress': 30,
@@ -378,6 +628,7 @@ def main():
                 '--batch-size', '4',
                 '--num-layers', '16',
                 '--learning-rate', '1e-5',
+                '--max-seq-length', str(MAX_SEQ_LENGTH),
                 '--steps-per-report', '1',  # Report every step for real-time updates
                 '--adapter-path', adapter_path,
             ]
@@ -391,76 +642,86 @@ def main():
                 cmd,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1
+                bufsize=0
             )
 
             current_iter = resume_from_iter  # Start from checkpoint
 
-            for line in process.stdout:
-                print(line.strip())  # Log to stdout
-
-                # Parse training output for progress
-                if 'Iter' in line and 'Train loss' in line:
+            # Parse each burst of output, then write progress once for the burst
+            recent_output = collections.deque(maxlen=RECENT_OUTPUT_LINES)
+            for lines in read_output_bursts(process):
+                latest = None
+                checkpointed = False
+
+                for line in lines:
+                    recent_output.append(line)
+
+                    # Parse training output for progress
+                    match = TRAIN_REPORT_PATTERN.search(line)
+                    if not match:
+                        # Always log non-report output (warnings, errors, tracebacks)
+                        print(line)
+                        continue
+                    if args.verbose:
+                        print(line)  # Log to stdout
+
+                    relative_iter, loss_str, lr_str = match.group(1, 2, 3)
                     try:
-                        # Parse line like "Iter 350: Train loss 0.158, Learning Rate 1.000e-05, ..."
-                        parts = line.split(',')
-                        iter_loss_part = parts[0]  # "Iter 350: Train loss 0.158"
-
-                        # Extract iteration number (relative to this run)
-                        iter_match = iter_loss_part.split(':')[0]  # "Iter 350"
-                        relative_iter = int(iter_match.split()[1])
                         # Add resume offset to get absolute iteration
-                        current_iter = resume_from_iter + relative_iter
-
-                        # Extract train loss (after "Train loss")
-                        if 'Train loss' in iter_loss_part:
-                            loss_str = iter_loss_part.split('Train loss')[1].strip()
-                            train_loss = float(loss_str)
-                        else:
-                            train_loss = None
-
-                        if train_loss:
-                            current_epoch = min(args.epochs, current_iter // iters_per_epoch + 1)
-                            progress = 30 + int((current_iter / total_iters) * 65)
-
-                            loss_history.append({
-                                'step': current_iter,
-                                'loss': train_loss,
-                                'epoch': current_epoch
-                            })
-
-                            write_progress(progress_file, {
-                                'stage': 'training',
-                                'progress': min(progress, 95),
-                                'message': f'Training epoch {current_epoch}/{args.epochs}',
-                                'epoch': current_epoch,
-                                'total_epochs': args.epochs,
-                                'loss': train_loss,
-                                'learning_rate': 1e-5,
-                                'dataset_size': dataset_size,
-                                'step': current_iter,
-                                'total_steps': total_iters,
-                                'loss_history': loss_history[-50:]
-                            })
-
-                            # Save checkpoint every 100 iterations
-                            if current_iter % 100 == 0:
-                                save_checkpoint(checkpoint_file, {
-                                    'last_iter': current_iter,
-                                    'last_loss': train_loss,
-                                    'epoch': current_epoch,
-                                    'loss_history': loss_history[-100:],
-                                    'total_iters': total_iters,
-                                    'dataset_size': dataset_size
-                                })
-                    except Exception as parse_error:
-                        pass  # Ignore parse errors
+                        current_iter = resume_from_iter + int(relative_iter)
+                        train_loss = float(loss_str)
+                        learning_rate = float(lr_str) if lr_str else 1e-5
+                    except ValueError:
+                        continue  # Ignore parse errors
+
+                    if not train_loss:
+                        continue
+
+                    current_epoch = min(args.epochs, current_iter // iters_per_epoch + 1)
+                    entry = {
+                        'step': current_iter,
+                        'loss': train_loss,
+                        'epoch': current_epoch
+                    }
+                    loss_history.append(entry)
+                    ui_tail.append(entry)
+                    checkpoint_tail.append(entry)
+                    latest = (current_iter, train_loss, learning_rate, current_epoch)
+
+                    # Save checkpoint every 100 iterations
+                    if current_iter % 100 == 0:
+                        checkpointed = True
+                        save_checkpoint(checkpoint_file, {
+                            'last_iter': current_iter,
+                            'last_loss': train_loss,
+                            'epoch': current_epoch,
+                            'loss_history': list(checkpoint_tail),
+                            'total_iters': total_iters,
+                            'dataset_size': dataset_size
+                        })
+
+                if latest:
+                    step, train_loss, learning_rate, current_epoch = latest
+                    progress = 30 + int((step / total_iters) * 65)
+                    write_progress(progress_file, {
+                        'stage': 'training',
+                        'progress': min(progress, 95),
+                        'message': f'Training epoch {current_epoch}/{args.epochs}',
+                        'epoch': current_epoch,
+                        'total_epochs': args.epochs,
+                        'loss': train_loss,
+                        'learning_rate': learning_rate,
+                        'dataset_size': dataset_size,
+                        'step': step,
+                        'total_steps': total_iters,
+                        'loss_history': list(ui_tail)
+                    }, force=checkpointed)
 
             process.wait()
 
             if process.returncode != 0:
-                raise Exception(f"Training failed with exit code {process.returncode}")
+                output_tail = '\n'.join(recent_output)
+                raise Exception(f"Training failed with exit code {process.returncode}:\n{output_tail}")
 
         write_progress(progress_file, {
             'stage': 'fusing_model',
@@ -471,7 +732,7 @@ def main():
             'loss': loss_history[-1]['loss'] if loss_history else None,
             'learning_rate': None,
             'dataset_size': dataset_size,
-            'loss_history': loss_history
+            'loss_history': list(loss_history)
         })
 
         # Fuse LoRA adapters with base model (with dequantization for GGUF conversion)
@@ -494,50 +755,67 @@ def main():
             'loss': loss_history[-1]['loss'] if loss_history else None,
             'learning_rate': None,
             'dataset_size': dataset_size,
-            'loss_history': loss_history
+            'loss_history': list(loss_history)
         })
 
-        # Convert to single-file safetensors (required for llama.cpp conversion)
-        single_path = str(output_path / 'fused-single')
+        # Convert the fused directory straight to GGUF - convert_hf_to_gguf.py reads
+        # sharded safetensors via the index, so no reload/resave through PyTorch is needed
         gguf_path = str(output_path / f'{args.output}.gguf')
+        f16_gguf_path = str(output_path / f'{args.output}-f16.gguf')
+        quantized = False
 
         try:
-            import torch
-            from transformers import AutoModelForCausalLM, AutoTokenizer
-
-            print("Loading fused model for GGUF conversion...")
-            model = AutoModelForCausalLM.from_pretrained(fused_path, torch_dtype=torch.float16)
-            tokenizer = AutoTokenizer.from_pretrained(fused_path)
-
-            print("Saving as single file...")
-            os.makedirs(single_path, exist_ok=True)
-            model.save_pretrained(single_path, max_shard_size="100GB")
-            tokenizer.save_pretrained(single_path)
-
-            # Convert to GGUF using llama.cpp
-            llama_cpp_path = "/Volumes/AI_SSD/ai-local/llama.cpp"
-            convert_script = os.path.join(llama_cpp_path, "convert_hf_to_gguf.py")
-
-            if os.path.exists(convert_script):
-                print("Converting to GGUF format...")
+            # Convert to GGUF with the local or pinned, hash-verified llama.cpp script
+            convert_script = str(find_convert_script())
+            install_conversion_deps()
+
+            print("Converting to GGUF format...")
+            convert_result = subprocess.run([
+                sys.executable, convert_script,
+                '--outtype', 'f16',
+                '--outfile', f16_gguf_path,
+                fused_path
+            ], capture_output=True, text=True)
+
+            if convert_result.returncode != 0:
+                # Retry from a single-file copy, merged shard by shard
+                print(f"GGUF conversion from shards failed, retrying with merged safetensors: {convert_result.stderr}")
+                single_path = str(output_path / 'fused-single')
+                merge_safetensors_shards(fused_path, single_path)
                 convert_result = subprocess.run([
                     sys.executable, convert_script,
                     '--outtype', 'f16',
-                    '--outfile', gguf_path,
+                    '--outfile', f16_gguf_path,
                     single_path
                 ], capture_output=True, text=True)
 
-                if convert_result.returncode != 0:
-                    print(f"GGUF conversion warning: {convert_result.stderr}")
-                    gguf_path = None
-            else:
-                print(f"llama.cpp convert script not found at {convert_script}")
+            if convert_result.returncode != 0:
+                print(f"GGUF conversion warning: {convert_result.stderr}")
                 gguf_path = None
+            else:
+                try:
+                    quantize_gguf(f16_gguf_path, gguf_path)
+                    os.remove(f16_gguf_path)
+                    quantized = True
+                except Exception as quantize_error:
+                    print(f"{GGUF_QUANT_TYPE} quantization unavailable, keeping F16 GGUF: {quantize_error}")
+                    os.replace(f16_gguf_path, gguf_path)
 
         except Exception as e:
             print(f"GGUF conversion failed: {e}")
             gguf_path = None
 
+        # The merged single-file copy is only a conversion input - never keep it.
+        # Any F16 GGUF still here is a failed conversion's partial output.
+        shutil.rmtree(str(output_path / 'fused-single'), ignore_errors=True)
+        if os.path.exists(f16_gguf_path):
+            os.remove(f16_gguf_path)
+
+        # Once quantized, the GGUF is the only artifact Ollama needs - drop the FP16
+        # fused model (the adapters are kept, so the model can always be re-fused)
+        if quantized:
+            shutil.rmtree(fused_path, ignore_errors=True)
+
         write_progress(progress_file, {
             'stage': 'importing_ollama',
             'progress': 99,
@@ -547,7 +825,7 @@ def main():
             'loss': loss_history[-1]['loss'] if loss_history else None,
             'learning_rate': None,
             'dataset_size': dataset_size,
-            'loss_history': loss_history
+            'loss_history': list(loss_history)
         })
 
         # Create Ollama Modelfile - prefer GGUF if available
@@ -600,8 +878,8 @@ PARAMETER num_ctx 4096
             'final_loss': final_loss,
             'learning_rate': None,
             'dataset_size': dataset_size,
-            'loss_history': loss_history,
-            'model_path': fused_path,
+            'loss_history': list(loss_history),
+            'model_path': model_source,
             'ollama_model': args.output
         })
 